@@ -4,22 +4,30 @@ from PIL import Image
 
 class Custom_Dataset(Dataset):
 
-  def __init__(self, root, txt, transform=None, returnPath=False, pre_load=False, pathReplace={}):
+  def __init__(self, root, txt, transform=None, returnPath=False, pre_load=False, pathReplace={}, paths=None, labels=None):
     self.img_path = []
     self.labels = []
     self.root = root
     self.transform = transform
     self.returnPath = returnPath
     self.txt = txt
+    self.pathReplace = pathReplace
+    self.relative_paths = paths is not None
 
-    with open(txt) as f:
-      for line in f:
-        label = line.split()[-1]
-        self.img_path.append(os.path.join(root, line[:-(len(label) + 2)]))
-        self.labels.append(int(label))
+    if paths is None:
+      with open(txt) as f:
+        for line in f:
+          label = line.split()[-1]
+          self.img_path.append(os.path.join(root, line[:-(len(label) + 2)]))
+          self.labels.append(int(label))
 
-    for key, item in pathReplace.items():
-      self.img_path = [p.replace(key, item) for p in self.img_path]
+      for key, item in pathReplace.items():
+        self.img_path = [p.replace(key, item) for p in self.img_path]
+    else:
+      # the split is already parsed (see utils.init_datasets.load_split), keep the relative paths as numpy
+      # arrays so that the dataloader workers share them, the full path is only resolved in get_path
+      self.img_path = paths
+      self.labels = labels
 
     self.pre_load = pre_load
     if pre_load:
@@ -28,7 +36,7 @@ class Custom_Dataset(Dataset):
       for idx in range(len(self.img_path)):
         if idx % 100 == 0 and idx > 0:
           print("loading {}/{}".format(idx, len(self.img_path)))
-        path = self.img_path[idx]
+        path = self.get_path(idx)
         with open(path, 'rb') as f:
           sample = Image.open(f).convert('RGB')
         self.imgs[idx] = sample
@@ -38,10 +46,19 @@ class Custom_Dataset(Dataset):
   def __len__(self):
     return len(self.labels)
 
+  def get_path(self, index):
+    if not self.relative_paths:
+      return self.img_path[index]
+
+    path = os.path.join(self.root, str(self.img_path[index]))
+    for key, item in self.pathReplace.items():
+      path = path.replace(key, item)
+    return path
+
   def __getitem__(self, index):
 
-    path = self.img_path[index]
-    label = self.labels[index]
+    path = self.get_path(index)
+    label = int(self.labels[index])
 
     if not self.pre_load:
       with open(path, 'rb') as f:
@@ -5,6 +5,7 @@ Train and eval functions used in main.py
 """
 import math
 import sys
+from collections import defaultdict
 from typing import Iterable, Optional
 
 import torch
@@ -13,7 +14,7 @@ from  torch import nn
 from timm.data import Mixup
 from timm.utils import accuracy, ModelEma
 
-from utils.moe_utils import collect_noisy_gating_loss, collect_moe_activation
+from utils.moe_utils import collect_noisy_gating_loss, collect_moe_activation, stop_after_last_gate
 from utils.lr_sched import adjust_learning_rate
 
 from moco.builder import concat_all_gather
@@ -22,60 +23,185 @@ from pdb import set_trace
 
 from .losses import DistillationLoss
 
-def contrastive_loss(q, k, temp=0.2):
+# run the fp32 matmuls/convs outside of the autocast regions (e.g. the contrastive logits) on TF32 tensor cores
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+if hasattr(torch, "set_float32_matmul_precision"):
+    torch.set_float32_matmul_precision('high')
+
+_LABEL_CACHE = {}
+
+
+def _get_labels(N, rank, device):
+    # the contrastive targets only depend on the batch size and the rank, keep them on device
+    key = (N, rank, device)
+    labels = _LABEL_CACHE.get(key)
+    if labels is None:
+        labels = torch.arange(N, dtype=torch.long, device=device) + N * rank
+        _LABEL_CACHE[key] = labels
+    return labels
+
+
+_DIAG_INDEX_CACHE = {}
+
+
+def _get_diag_index(N, M, rank, device):
+    # flat offsets of the (i, i + N * rank) diagonal of a N x M matrix, fixed for a given batch size and rank
+    key = (N, M, rank, device)
+    index = _DIAG_INDEX_CACHE.get(key)
+    if index is None:
+        index = torch.arange(N, dtype=torch.long, device=device) * (M + 1) + N * rank
+        _DIAG_INDEX_CACHE[key] = index
+    return index
+
+
+@torch.no_grad()
+def gather_layers_async(k, label=None):
+    # launch the all-gather of a stacked (L, N, C) tensor along the batch dimension without blocking,
+    # the returned callable waits for the collective and assembles the gathered tensor.
+    # if the (N,) labels are given they share the same collective and the callable returns (k, label)
+    if not torch.distributed.is_initialized():
+        return lambda: k if label is None else (k, label)
+    L, N, C = k.shape
+    k_dtype = k.dtype
+    packed = k.transpose(0, 1).reshape(N, L * C)
+    if label is not None:
+        # the labels ride along as one extra fp32 column, exact for any realistic number of classes
+        packed = torch.cat([packed.float(), label.unsqueeze(1).float()], dim=1)
+    packed = packed.contiguous()
+    tensors_gather = [torch.empty_like(packed) for _ in range(torch.distributed.get_world_size())]
+    work = torch.distributed.all_gather(tensors_gather, packed, async_op=True)
+
+    def wait():
+        work.wait()
+        gathered = torch.cat(tensors_gather, dim=0)
+        k_all = gathered[:, :L * C].reshape(-1, L, C).transpose(0, 1).to(k_dtype)
+        if label is None:
+            return k_all
+        return k_all, gathered[:, L * C].to(label.dtype)
+
+    return wait
+
+
+def gather_layers(k, label=None):
+    # gather a stacked (L, N, C) tensor (and optionally its labels) along the batch dimension
+    return gather_layers_async(k, label)()
+
+
+def contrastive_loss(q, k, temp=0.2, k_gathered=False):
+    # q, k are (N, C) or stacked over the moe layers as (L, N, C), the loss is summed over the layers
+    # k_gathered: k is already normalized and gathered from all the ranks
+    if q.dim() == 2:
+        q, k = q.unsqueeze(0), k.unsqueeze(0)
+    L = q.shape[0]
     # normalize
-    q = nn.functional.normalize(q, dim=1)
-    k = nn.functional.normalize(k, dim=1)
-    # gather all targets
-    k = concat_all_gather(k)
-    # Einstein sum is more intuitive
-    logits = torch.einsum('nc,mc->nm', [q, k]) / temp
+    q = nn.functional.normalize(q, dim=2)
+    if not k_gathered:
+        k = nn.functional.normalize(k, dim=2)
+        # gather all targets
+        k = gather_layers(k)
+    # one batched GEMM for all the layers, einsum would go through bmm with extra reshapes
+    logits = torch.bmm(q, k.transpose(1, 2)).div_(temp)
     # print("logits mean is {}".format(logits.mean()))
-    N = logits.shape[0]  # batch size per GPU
-    labels = (torch.arange(N, dtype=torch.long) + N * torch.distributed.get_rank()).cuda()
+    N = logits.shape[1]  # batch size per GPU
+    labels = _get_labels(N, torch.distributed.get_rank(), logits.device)
     # print("labels is {}".format(labels))
-    return nn.CrossEntropyLoss()(logits, labels) * (2 * temp)
+    return nn.functional.cross_entropy(logits.flatten(0, 1), labels.repeat(L)) * (2 * temp * L)
 
 
-def supervised_contrastive_loss(q, k, label, temp=0.2):
+def supervised_contrastive_loss(q, k, label, temp=0.2, k_gathered=False, label_k=None):
     # exclude the data with the same label
+    # q, k are (N, C) or stacked over the moe layers as (L, N, C), the loss is summed over the layers
+    # k_gathered: k is already normalized and gathered from all the ranks, label_k are the matching gathered labels
+    if q.dim() == 2:
+        q, k = q.unsqueeze(0), k.unsqueeze(0)
+    L = q.shape[0]
 
     # normalize
-    q = nn.functional.normalize(q, dim=1)
-    k = nn.functional.normalize(k, dim=1)
-    # gather all targets
-    if torch.distributed.is_initialized():
-        k = concat_all_gather(k)
+    q = nn.functional.normalize(q, dim=2)
+    if not k_gathered:
+        k = nn.functional.normalize(k, dim=2)
+        # gather all targets, the labels share the collective
+        k, label_k = gather_layers(k, label)
+    elif label_k is None:
+        label_k = concat_all_gather(label) if torch.distributed.is_initialized() else label
 
     supervised_label_q = label
-    supervised_label_k = label
-    if torch.distributed.is_initialized():
-        supervised_label_k = concat_all_gather(supervised_label_k)
+    supervised_label_k = label_k
 
-    # only save the different data
-    label_mask = (torch.abs(supervised_label_q.unsqueeze(1) - supervised_label_k.unsqueeze(0)) > 0)
-    # include the logits of the same sample
+    # only save the different data, the pairs with the same label are masked out by an additive -inf bias
+    # that is folded into the GEMM
+    same_label = supervised_label_q.unsqueeze(1).eq(supervised_label_k.unsqueeze(0))
+    neg_inf_mask = torch.zeros(same_label.shape, dtype=q.dtype, device=q.device).masked_fill_(same_label, float('-inf'))
 
-    N = label_mask.shape[0]
+    N, M = neg_inf_mask.shape
     if torch.distributed.is_initialized():
         rank = torch.distributed.get_rank()
     else:
         rank = 0
 
-    label_mask[torch.arange(N, dtype=torch.long), torch.arange(N, dtype=torch.long) + N * rank] = True
-
-    # Einstein sum is more intuitive
-    logits = torch.einsum('nc,mc->nm', [q, k]) / temp
+    labels = _get_labels(N, rank, neg_inf_mask.device)
+    # include the logits of the same sample
+    neg_inf_mask.view(-1).index_fill_(0, _get_diag_index(N, M, rank, neg_inf_mask.device), 0)
 
-    # mask out the pair with the same label
-    logits.masked_fill_(~label_mask.bool().detach(), float('-inf'))
+    logits = torch.baddbmm(neg_inf_mask.unsqueeze(0), q, k.transpose(1, 2), alpha=1 / temp)
 
-    # print("logits mean is {}".format(logits.mean()))
-    N = logits.shape[0]  # batch size per GPU
-    labels = (torch.arange(N, dtype=torch.long) + N * rank).cuda()
     # print("labels is {}".format(labels))
 
-    return nn.CrossEntropyLoss()(logits, labels) * (2 * temp)
+    return nn.functional.cross_entropy(logits.flatten(0, 1), labels.repeat(L)) * (2 * temp * L)
+
+
+class CUDAPrefetcher(object):
+    """Wrap a data loader and copy the next batch to the device on a side stream while the current batch is
+    being processed.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, obj):
+        if isinstance(obj, torch.Tensor):
+            # pinning is left to the data loader (--pin-mem), an unpinned batch is just copied as is
+            return obj.to(self.device, non_blocking=True)
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._to_device(o) for o in obj)
+        return obj
+
+    def _record_stream(self, obj, stream):
+        # the batch is allocated on the side stream, keep the allocator from reusing it too early
+        if isinstance(obj, torch.Tensor):
+            obj.record_stream(stream)
+        elif isinstance(obj, (list, tuple)):
+            for o in obj:
+                self._record_stream(o, stream)
+
+    def __iter__(self):
+        if not torch.cuda.is_available():
+            yield from self.loader
+            return
+
+        stream = torch.cuda.Stream()
+        loader = iter(self.loader)
+
+        def preload():
+            try:
+                batch = next(loader)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return self._to_device(batch)
+
+        next_batch = preload()
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(stream)
+            batch = next_batch
+            self._record_stream(batch, torch.cuda.current_stream())
+            next_batch = preload()
+            yield batch
 
 
 def train_one_epoch(model: torch.nn.Module, criterion: DistillationLoss,
@@ -88,7 +214,10 @@ def train_one_epoch(model: torch.nn.Module, criterion: DistillationLoss,
     metric_logger.add_meter('lr', SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 10
+    # detached loss tensors, only copied to the host at the logging boundaries
+    pending_meters = defaultdict(list)
 
+    data_loader = CUDAPrefetcher(data_loader, device)
     for data_iter_step, (samples, targets) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
 
         # we use a per iteration (instead of per epoch) lr scheduler
@@ -109,37 +238,46 @@ def train_one_epoch(model: torch.nn.Module, criterion: DistillationLoss,
             samples, targets = mixup_fn(samples, targets)
 
         with torch.cuda.amp.autocast():
+            if args.moe_contrastive_weight > 0:
+                # run the key forward first, so that the all-gather of its gates overlaps with the main forward
+                with torch.no_grad():
+                    # only the gates are needed, skip everything after the last moe gate
+                    with stop_after_last_gate(model):
+                        model(samples_second)
+                    k_gate = collect_moe_activation(model, samples_second.shape[0], activation_suppress="origin")
+                    # stack the cls token gates of all the moe layers to (L, N, C)
+                    k_g = nn.functional.normalize(torch.stack([g[:, 0] for g in k_gate]), dim=2)
+                    # the supervised loss also needs the labels of all the ranks, gather them in the same collective
+                    wait_k_g = gather_layers_async(k_g, targets_discrete if args.moe_contrastive_supervised else None)
+
             outputs = model(samples)
             loss = criterion(samples, outputs, targets)
-            loss_value = loss.item()
+            loss_value = loss.detach()  # the gate/load losses are added out of place below, so this stays the criterion loss
 
             if args.moe_contrastive_weight > 0:
                 q_gate = collect_moe_activation(model, outputs.shape[0], activation_suppress="origin")
 
-                with torch.no_grad():
-                    outputs_second = model(samples_second)
-                    k_gate = collect_moe_activation(model, outputs_second.shape[0], activation_suppress="origin")
-
                 assert isinstance(q_gate, list)
-                loss_gate = 0
-                for q_g, k_g in zip(q_gate, k_gate):
-                    # print("q_g shape is {}, k_g shape is {}".format(q_g.shape, k_g.shape))
-                    if args.moe_contrastive_supervised:
-                        # moe_contrastive_supervised
-                        loss_gate += args.moe_contrastive_weight * supervised_contrastive_loss(q_g[:, 0], k_g[:, 0], targets_discrete)
-                    else:
-                        loss_gate += args.moe_contrastive_weight * contrastive_loss(q_g[:, 0], k_g[:, 0])
+                # compute the loss of all the moe layers in one go
+                q_g = torch.stack([g[:, 0] for g in q_gate])
+                # print("q_g shape is {}".format(q_g.shape))
+                if args.moe_contrastive_supervised:
+                    # moe_contrastive_supervised
+                    k_g, targets_all = wait_k_g()
+                    loss_gate = args.moe_contrastive_weight * supervised_contrastive_loss(q_g, k_g, targets_discrete,
+                                                                                          k_gathered=True,
+                                                                                          label_k=targets_all)
+                else:
+                    k_g = wait_k_g()
+                    loss_gate = args.moe_contrastive_weight * contrastive_loss(q_g, k_g, k_gathered=True)
                 # print("loss_gate.item() is {}".format(loss_gate.item()))
-                metric_logger.update(loss_gate=loss_gate.item())
-                loss += loss_gate
+                pending_meters['loss_gate'].append(loss_gate.detach())
+                loss = loss + loss_gate
 
         if args.arch.startswith('moe_vit'):
             loss_load = collect_noisy_gating_loss(model, args.moe_noisy_gate_loss_weight)
             # metric_logger.update(loss_load=loss_load.item())
-            loss += loss_load
-
-        if not math.isfinite(loss_value):
-            raise ValueError("Loss is {}, stopping training".format(loss_value))
+            loss = loss + loss_load
 
         optimizer.zero_grad()
 
@@ -148,11 +286,18 @@ def train_one_epoch(model: torch.nn.Module, criterion: DistillationLoss,
         loss_scaler(loss, optimizer, clip_grad=max_norm,
                     parameters=model.parameters(), create_graph=is_second_order)
 
-        torch.cuda.synchronize()
         if model_ema is not None:
             model_ema.update(model)
 
-        metric_logger.update(loss=loss_value)
+        pending_meters['loss'].append(loss_value)
+        if data_iter_step % print_freq == 0 or data_iter_step == len(data_loader) - 1:
+            for name, values in pending_meters.items():
+                values = torch.stack(values).tolist()
+                for value in values:
+                    if name == 'loss' and not math.isfinite(value):
+                        raise ValueError("Loss is {}, stopping training".format(value))
+                    metric_logger.update(**{name: value})
+            pending_meters.clear()
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
 
     # gather the stats from all processes
@@ -166,6 +311,8 @@ def evaluate(data_loader, model, device, log):
     criterion = torch.nn.CrossEntropyLoss()
 
     metric_logger = MetricLogger(delimiter="  ", log=log)
+    metric_logger.add_meter('acc1', SmoothedValue())
+    metric_logger.add_meter('acc5', SmoothedValue())
     header = 'Test:'
 
     # switch to evaluation mode
@@ -184,8 +331,8 @@ def evaluate(data_loader, model, device, log):
 
         batch_size = images.shape[0]
         metric_logger.update(loss=loss.item())
-        metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
-        metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
+        metric_logger.acc1.update(acc1.item(), n=batch_size)
+        metric_logger.acc5.update(acc5.item(), n=batch_size)
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -199,8 +346,9 @@ def evaluate(data_loader, model, device, log):
 import io
 import os
 import time
-from collections import defaultdict, deque
+from collections import deque
 import datetime
+from statistics import median as _median
 
 import torch
 import torch.distributed as dist
@@ -235,15 +383,15 @@ class SmoothedValue(object):
         self.count = int(t[0])
         self.total = t[1]
 
+    # the window statistics are 0.0 for an empty window
     @property
     def median(self):
-        d = torch.tensor(list(self.deque))
-        return d.median().item()
+        # plain python is far cheaper than numpy/torch for a window this small
+        return _median(self.deque) if self.deque else 0.0
 
     @property
     def avg(self):
-        d = torch.tensor(list(self.deque), dtype=torch.float32)
-        return d.mean().item()
+        return sum(self.deque) / len(self.deque) if self.deque else 0.0
 
     @property
     def global_avg(self):
@@ -251,11 +399,11 @@ class SmoothedValue(object):
 
     @property
     def max(self):
-        return max(self.deque)
+        return max(self.deque) if self.deque else 0.0
 
     @property
     def value(self):
-        return self.deque[-1]
+        return self.deque[-1] if self.deque else 0.0
 
     def __str__(self):
         return self.fmt.format(
@@ -268,7 +416,7 @@ class SmoothedValue(object):
 
 class MetricLogger(object):
     def __init__(self, delimiter="\t", log=None):
-        self.meters = defaultdict(SmoothedValue)
+        self.meters = {}
         self.delimiter = delimiter
         self.log = log
 
@@ -277,7 +425,11 @@ class MetricLogger(object):
             if isinstance(v, torch.Tensor):
                 v = v.item()
             assert isinstance(v, (float, int))
-            self.meters[k].update(v)
+            meter = self.meters.get(k)
+            if meter is None:
+                meter = SmoothedValue()
+                self.add_meter(k, meter)
+            meter.update(v)
 
     def __getattr__(self, attr):
         if attr in self.meters:
@@ -296,11 +448,22 @@ class MetricLogger(object):
         return self.delimiter.join(loss_str)
 
     def synchronize_between_processes(self):
-        for meter in self.meters.values():
-            meter.synchronize_between_processes()
+        # a single all-reduce for the (count, total) pairs of all the meters, sorted so the ranks agree on the layout
+        names = sorted(self.meters.keys())
+        if not names:
+            return
+        t = torch.tensor([[self.meters[name].count, self.meters[name].total] for name in names],
+                         dtype=torch.float64, device='cuda')
+        dist.all_reduce(t)
+        for name, (count, total) in zip(names, t.tolist()):
+            self.meters[name].count = int(count)
+            self.meters[name].total = total
 
     def add_meter(self, name, meter):
         self.meters[name] = meter
+        # also expose the meter as a plain attribute, so that e.g. metric_logger.loss skips __getattr__
+        if not hasattr(type(self), name) and name not in ('meters', 'delimiter', 'log'):
+            self.__dict__[name] = meter
 
     def log_every(self, iterable, print_freq, header=None):
         i = 0
@@ -323,11 +486,25 @@ class MetricLogger(object):
             log_msg.append('max mem: {memory:.0f}')
         log_msg = self.delimiter.join(log_msg)
         MB = 1024.0 * 1024.0
+        # without a per-iteration device sync the host clock only sees the launch time, so the iteration
+        # time is measured with cuda events that are only read back at the logging boundaries
+        if torch.cuda.is_available():
+            iter_events = [torch.cuda.Event(enable_timing=True)]
+            iter_events[0].record()
         for obj in iterable:
             data_time.update(time.time() - end)
             yield obj
-            iter_time.update(time.time() - end)
+            if torch.cuda.is_available():
+                iter_events.append(torch.cuda.Event(enable_timing=True))
+                iter_events[-1].record()
+            else:
+                iter_time.update(time.time() - end)
             if i % print_freq == 0 or i == len(iterable) - 1:
+                if torch.cuda.is_available():
+                    iter_events[-1].synchronize()
+                    for start_event, end_event in zip(iter_events[:-1], iter_events[1:]):
+                        iter_time.update(start_event.elapsed_time(end_event) / 1000)
+                    iter_events = iter_events[-1:]
                 eta_seconds = iter_time.global_avg * (len(iterable) - i)
                 eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
                 if torch.cuda.is_available():
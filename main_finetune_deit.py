@@ -1,6 +1,7 @@
 # Copyright (c) 2015-present, Facebook, Inc.
 # All rights reserved.
 import argparse
+import inspect
 import math
 import os
 import random
@@ -80,6 +81,9 @@ def get_args_parser():
     parser.add_argument('--moe-noisy-gate-loss-weight', default=0.01, type=float)
     parser.add_argument('--moe-gate-type', default="noisy", type=str)
     parser.add_argument('--vmoe-noisy-std', default=0, type=float)
+    parser.add_argument('--grad-checkpoint-interval', default=0, type=int,
+                        help='checkpoint every k-th dense vit block to free its internal activations, '
+                             '-1 for round(sqrt(number of dense blocks)), 0 to disable (default)')
 
     # Optimizer parameters
     parser.add_argument('--opt', default='adamw', type=str, metavar='OPTIMIZER',
@@ -223,14 +227,16 @@ def create_model(args, nb_classes, log):
             model = vits_moe.__dict__[args.arch](moe_mlp_ratio=args.moe_mlp_ratio, moe_experts=args.moe_experts, moe_top_k=args.moe_top_k,
                                                  world_size=moe_world_size, gate_dim=gate_model.num_features,
                                                  num_classes=nb_classes,
-                                                 moe_gate_type=args.moe_gate_type, vmoe_noisy_std=args.vmoe_noisy_std)
+                                                 moe_gate_type=args.moe_gate_type, vmoe_noisy_std=args.vmoe_noisy_std,
+                                                 grad_checkpoint_interval=args.grad_checkpoint_interval)
             model = VisionTransformerMoCoWithGate(model, gate_model)
         else:
             model = vits_moe.__dict__[args.arch](moe_experts=args.moe_experts, moe_top_k=args.moe_top_k,
                                                  world_size=moe_world_size,
                                                  moe_mlp_ratio=args.moe_mlp_ratio,
                                                  num_classes=nb_classes,
-                                                 moe_gate_type=args.moe_gate_type, vmoe_noisy_std=args.vmoe_noisy_std)
+                                                 moe_gate_type=args.moe_gate_type, vmoe_noisy_std=args.vmoe_noisy_std,
+                                                 grad_checkpoint_interval=args.grad_checkpoint_interval)
         linear_keyword = 'head'
     else:
         model = torchvision_models.__dict__[args.arch](num_classes=nb_classes)
@@ -498,7 +504,18 @@ def main(args):
         model = fmoe.DistributedGroupedDataParallel(model)
         sync_weights(model, except_key_words=["mlp.experts.h4toh", "mlp.experts.htoh4"])
     else:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank])
+        # the set of used parameters only stays fixed across iterations for the dense models, which lets DDP
+        # overlap the gradient all-reduce with the backward pass. the buffers only need to be broadcast when
+        # there are batch norm running stats to keep in sync (e.g. the torchvision resnets)
+        has_bn = any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in model.modules())
+        ddp_kwargs = {}
+        # static_graph only exists from torch 1.11, older versions keep the graph dynamic
+        if "static_graph" in inspect.signature(torch.nn.parallel.DistributedDataParallel.__init__).parameters:
+            ddp_kwargs["static_graph"] = "moe" not in args.arch
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
+                                                          broadcast_buffers=has_bn,
+                                                          find_unused_parameters=False,
+                                                          **ddp_kwargs)
     model_without_ddp = model.module
 
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -14,6 +14,7 @@ Hacked together by / Copyright 2020 Ross Wightman
 """
 import math
 import logging
+import inspect
 from functools import partial
 from collections import OrderedDict
 from copy import deepcopy
@@ -21,6 +22,7 @@ from copy import deepcopy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.models.helpers import build_model_with_cfg, overlay_external_default_cfg
@@ -36,6 +38,9 @@ from .vision_transformer import matmul
 
 _logger = logging.getLogger(__name__)
 
+# use_reentrant only exists from torch 1.11, older versions always use the reentrant checkpoint
+_CHECKPOINT_KWARGS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
 
 def _cfg(url='', **kwargs):
     return {
@@ -257,7 +262,7 @@ class VisionTransformerMoE(nn.Module):
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0., embed_layer=PatchEmbed, norm_layer=None,
                  act_layer=None, weight_init='', moe_mlp_ratio=-1, moe_experts=64, moe_top_k=2, world_size=1, gate_dim=-1,
                  gate_return_decoupled_activation=False, gate_return_gated_activation=False,
-                 moe_gate_type="noisy", vmoe_noisy_std=1, moe_same_for_all=False):
+                 moe_gate_type="noisy", vmoe_noisy_std=1, moe_same_for_all=False, grad_checkpoint_interval=0):
         """
         Args:
             img_size (int, tuple): input image size
@@ -278,6 +283,8 @@ class VisionTransformerMoE(nn.Module):
             embed_layer (nn.Module): patch embedding layer
             norm_layer: (nn.Module): normalization layer
             weight_init: (str): weight init scheme
+            grad_checkpoint_interval (int): checkpoint every k-th dense block during training, which only frees the
+                internal activations of those blocks, -1 for round(sqrt(number of dense blocks)), 0 (default) to disable
         """
         super().__init__()
         self.num_classes = num_classes
@@ -327,6 +334,15 @@ class VisionTransformerMoE(nn.Module):
                 blocks.append(block)
         self.blocks = nn.Sequential(*blocks)
 
+        # the moe blocks are never recomputed, their gates record the activation and loss as a side effect,
+        # so only every k-th dense block is checkpointed on its own. the dense and moe blocks alternate, so this
+        # saves the attention/mlp internals of the checkpointed blocks, not a sqrt(depth) segment schedule
+        dense_idx = [i for i, block in enumerate(blocks) if not block.moe]
+        if grad_checkpoint_interval < 0:
+            grad_checkpoint_interval = int(round(math.sqrt(len(dense_idx))))
+        self.grad_checkpoint_interval = grad_checkpoint_interval
+        self.grad_checkpoint_blocks = set(dense_idx[::grad_checkpoint_interval]) if grad_checkpoint_interval > 0 else set()
+
         self.norm = norm_layer(embed_dim)
 
         # Representation layer
@@ -414,24 +430,31 @@ class VisionTransformerMoE(nn.Module):
             x = torch.cat((cls_token, self.dist_token.expand(x.shape[0], -1, -1), x), dim=1)
         x = self.pos_drop(x + self.interpolate_pos_encoding(x, w, h))
 
-        for block in self.blocks:
+        max_logits = []
+        for i, block in enumerate(self.blocks):
             if block.moe:
                 x = block(x, gate_inp)
+            elif i in self.grad_checkpoint_blocks and self.training and torch.is_grad_enabled():
+                x = checkpoint(block, x, **_CHECKPOINT_KWARGS)
             else:
                 x = block(x)
 
-            max_logits = torch.abs(x).max()
-            torch.distributed.all_reduce(max_logits)
-            if torch.isnan(max_logits):
-                torch.save(x_origin, "x_origin.pth")
-                save_state_dict = self.state_dict()
-                save_checkpoint({
-                    'epoch': 111,
-                    'state_dict': save_state_dict,
-                }, is_best=False, filename='nan.pth.tar',
-                save_dir=".", moe_save=True)
-                torch.distributed.barrier()
-                raise ValueError("logit is nan, stopping training")
+            max_logits.append(torch.abs(x).max())
+
+        # check all the blocks for nan with a single all-reduce and host sync after the loop, a per-block
+        # blocking collective would serialize the forward behind any in-flight async collective
+        max_logits = torch.stack(max_logits)
+        torch.distributed.all_reduce(max_logits)
+        if torch.isnan(max_logits).any():
+            torch.save(x_origin, "x_origin.pth")
+            save_state_dict = self.state_dict()
+            save_checkpoint({
+                'epoch': 111,
+                'state_dict': save_state_dict,
+            }, is_best=False, filename='nan.pth.tar',
+            save_dir=".", moe_save=True)
+            torch.distributed.barrier()
+            raise ValueError("logit is nan, stopping training")
 
         x = self.norm(x)
         if self.dist_token is None:
@@ -1,4 +1,6 @@
 import os
+import functools
+import tempfile
 import numpy as np
 
 from dataset.customDataset import Custom_Dataset
@@ -10,16 +12,16 @@ def init_datasets(args, transform_train, transform_test):
         # Data loading code
         root, txt_train, txt_val, txt_test, pathReplaceDict = get_imagenet_root_split(args.data, args.customSplit)
 
-        train_datasets = Custom_Dataset(root=root, txt=txt_train, transform=transform_train, pathReplace=pathReplaceDict)
-        val_datasets = Custom_Dataset(root=root, txt=txt_val, transform=transform_test, pathReplace=pathReplaceDict)
-        test_datasets = Custom_Dataset(root=root, txt=txt_test, transform=transform_test, pathReplace=pathReplaceDict)
+        train_datasets = build_custom_dataset(root, txt_train, transform_train, pathReplace=pathReplaceDict)
+        val_datasets = build_custom_dataset(root, txt_val, transform_test, pathReplace=pathReplaceDict)
+        test_datasets = build_custom_dataset(root, txt_test, transform_test, pathReplace=pathReplaceDict)
     elif args.dataset == "imagenet100":
         # Data loading code
         root, txt_train, txt_val, txt_test, pathReplaceDict = get_imagenet100_root_split(args.data, args.customSplit)
 
-        train_datasets = Custom_Dataset(root=root, txt=txt_train, transform=transform_train, pathReplace=pathReplaceDict)
-        val_datasets = Custom_Dataset(root=root, txt=txt_val, transform=transform_test, pathReplace=pathReplaceDict)
-        test_datasets = Custom_Dataset(root=root, txt=txt_test, transform=transform_test, pathReplace=pathReplaceDict)
+        train_datasets = build_custom_dataset(root, txt_train, transform_train, pathReplace=pathReplaceDict)
+        val_datasets = build_custom_dataset(root, txt_val, transform_test, pathReplace=pathReplaceDict)
+        test_datasets = build_custom_dataset(root, txt_test, transform_test, pathReplace=pathReplaceDict)
     elif args.dataset == "cifar10":
         # the data distribution
         root, train_idx, val_idx = get_cifar10_data_split(args.data, args.customSplit)
@@ -32,21 +34,65 @@ def init_datasets(args, transform_train, transform_test):
     elif args.dataset == 'Pet37':
         root, txt_train, txt_val, txt_test = get_pet37_data_split(args.data, args.customSplit)
 
-        train_datasets = Custom_Dataset(root=root, txt=txt_train, transform=transform_train)
-        val_datasets = Custom_Dataset(root=root, txt=txt_val, transform=transform_test)
-        test_datasets = Custom_Dataset(root=root, txt=txt_test, transform=transform_test)
+        train_datasets = build_custom_dataset(root, txt_train, transform_train)
+        val_datasets = build_custom_dataset(root, txt_val, transform_test)
+        test_datasets = build_custom_dataset(root, txt_test, transform_test)
     elif args.dataset == 'food101':
         root, txt_train, txt_val, txt_test = get_food101_data_split(args.data, args.customSplit)
 
-        train_datasets = Custom_Dataset(root=root, txt=txt_train, transform=transform_train)
-        val_datasets = Custom_Dataset(root=root, txt=txt_val, transform=transform_test)
-        test_datasets = Custom_Dataset(root=root, txt=txt_test, transform=transform_test)
+        train_datasets = build_custom_dataset(root, txt_train, transform_train)
+        val_datasets = build_custom_dataset(root, txt_val, transform_test)
+        test_datasets = build_custom_dataset(root, txt_test, transform_test)
     else:
         raise ValueError("No such dataset: {}".format(args.dataset))
 
     return train_datasets, val_datasets, test_datasets
 
 
+def load_split(txt):
+    """
+    Parse a split txt of "<path> <label>" lines into (paths, labels) numpy arrays. The result is cached in a
+    sibling .npz, so the txt is only parsed again when it changes.
+    """
+    cache = os.path.splitext(txt)[0] + ".npz"
+    if os.path.isfile(cache) and os.path.getmtime(cache) >= os.path.getmtime(txt):
+        with np.load(cache) as data:
+            return data["paths"], data["labels"]
+
+    paths = []
+    labels = []
+    with open(txt) as f:
+        for line in f:
+            label = line.split()[-1]
+            paths.append(line[:-(len(label) + 2)])
+            labels.append(int(label))
+    paths = np.array(paths, dtype=str)
+    labels = np.array(labels, dtype=np.int32)
+
+    # write to a unique temporary file first, several ranks (possibly on other nodes sharing the filesystem)
+    # may build the cache at the same time
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(suffix=".tmp.npz", dir=os.path.dirname(os.path.abspath(cache)))
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, paths=paths, labels=labels)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, cache)
+    except OSError:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+    return paths, labels
+
+
+def build_custom_dataset(root, txt, transform, pathReplace=None):
+    paths, labels = load_split(txt)
+    return Custom_Dataset(root=root, txt=txt, transform=transform, pathReplace=pathReplace or {},
+                          paths=paths, labels=labels)
+
+
+# the isdir probes can be slow on network filesystems, resolve each root only once
+@functools.lru_cache(maxsize=None)
 def get_imagenet_root_path(root):
 
     pathReplaceDict = {}
@@ -63,6 +109,8 @@ def get_imagenet_root_path(root):
 
 def get_imagenet_root_split(root, customSplit, domesticAnimalSplit=False):
     root, pathReplaceDict = get_imagenet_root_path(root)
+    # the resolved dict is shared through the cache, hand out a copy
+    pathReplaceDict = dict(pathReplaceDict)
 
     txt_train = "split/imagenet/imagenet_train.txt"
     txt_val = "split/imagenet/imagenet_val.txt"
@@ -81,6 +129,7 @@ def get_imagenet_root_split(root, customSplit, domesticAnimalSplit=False):
 
 def get_imagenet100_root_split(root, customSplit):
     root, pathReplaceDict = get_imagenet_root_path(root)
+    pathReplaceDict = dict(pathReplaceDict)
 
     txt_train = "split/imagenet/ImageNet_100_train.txt"
     txt_val = "split/imagenet/ImageNet_100_val.txt"
@@ -92,6 +141,7 @@ def get_imagenet100_root_split(root, customSplit):
     return root, txt_train, txt_val, txt_test, pathReplaceDict
 
 
+@functools.lru_cache(maxsize=None)
 def get_cifar10_data_split(root, customSplit, ssl=False):
     # if ssl is True, use both train and val splits
     if os.path.isdir(root):
@@ -117,6 +167,7 @@ def get_cifar10_data_split(root, customSplit, ssl=False):
     return root, train_idx, val_idx
 
 
+@functools.lru_cache(maxsize=None)
 def get_pet37_path(root):
     if os.path.isdir(root):
         root = root
@@ -147,6 +198,7 @@ def get_pet37_data_split(root, customSplit, ssl=False):
     return root, txt_train, txt_val, txt_test
 
 
+@functools.lru_cache(maxsize=None)
 def get_food101_path(root):
     if os.path.isdir(root):
         root = root
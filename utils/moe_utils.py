@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from contextlib import contextmanager
 from models.gate_funs.noisy_gate import NoisyGate
 from models.gate_funs.noisy_gate_vmoe import NoisyGate_VMoE
 from models.custom_moe_layer import FMoETransformerMLP
@@ -108,6 +109,37 @@ def collect_moe_activation(model, batch_size, activation_suppress="pool", return
         return gate_activations, names
 
 
+class _EarlyExit(Exception):
+    pass
+
+
+@contextmanager
+def stop_after_last_gate(model):
+    """
+    Abort the forward pass of model once the gates of all its moe layers have fired. Use it when only the
+    gate activations (see collect_moe_activation) are needed, the rest of the network is skipped.
+    """
+    # a moe mlp shared by several blocks (moe_same_for_all) fires its gate once per block. modules() yields the
+    # shared mlp only once, but every parent block still lists it among its own children
+    gates = [child.gate for module in model.modules() for child in module.children()
+             if isinstance(child, FMoETransformerMLP)]
+    num_calls = [0]
+
+    def hook(module, inp, out):
+        num_calls[0] += 1
+        if num_calls[0] == len(gates):
+            raise _EarlyExit()
+
+    handles = [gate.register_forward_hook(hook) for gate in set(gates)]
+    try:
+        yield
+    except _EarlyExit:
+        pass
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
 def set_moe_mask(model, select_idx_dict):
     for name, module in model.named_modules():
         if (isinstance(module, NoisyGate) or isinstance(module, NoisyGate_VMoE)):